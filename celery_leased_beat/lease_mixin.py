@@ -1,24 +1,109 @@
+import hashlib
 import socket
 import os
+import threading
+import random
 import time
 import uuid
 import logging
-import urllib.parse
+import re
+from dataclasses import dataclass
 from celery.beat import Scheduler
 from redis import Redis
-from redis.sentinel import Sentinel
-from redis.cluster import RedisCluster
-from redis.exceptions import RedisError, LockError
-from redis.lock import Lock
-from typing import cast, TYPE_CHECKING
+from redis.exceptions import NoScriptError, RedisError
+from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
+    from redis.client import PubSub, PubSubWorkerThread
+    from redis.cluster import RedisCluster
+    from redis.connection import Connection, ConnectionPool
+
     __MixinBase = Scheduler
 else:
     __MixinBase = object
 
 logger = logging.getLogger(__name__)
 
+# `sentinel://[user:password@]host[:port]`, several nodes are separated by `;`.
+# Userinfo ends at the last `@` like urlparse, IPv6 hosts are bracketed: `sentinel://[::1]:26379`.
+_SENTINEL_RE = re.compile(r'sentinel://(?:[^/;]*@)?(?:\[([^\]]+)\]|([^:/;@\[]+))(?::(\d+))?')
+_SENTINEL_DEFAULT_PORT = 26379
+
+# Acquire the lease if it is free or extend it if we already own it, in a single round-trip.
+# Returns 1 when newly acquired and 2 when renewed. When the lease is held by someone else,
+# returns the negated PTTL of the holder in milliseconds, or 0 if it is unknown.
+_LEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return 2
+elseif redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+local pttl = redis.call('pttl', KEYS[1])
+if pttl > 0 then
+    return -pttl
+end
+return 0
+"""
+_LEASE_SHA = hashlib.sha1(_LEASE_LUA.encode()).hexdigest()
+
+# Delete the lease only if we still own it, same as redis-py's Lock.LUA_RELEASE_SCRIPT.
+_RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+
+def _pack_command(*args: bytes) -> bytes:
+    """Encode a command as a RESP array of bulk strings."""
+    return b''.join([b'*%d\r\n' % len(args)] + [b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in args])
+
+
+@dataclass(frozen=True, slots=True)
+class _LeaseConfig:
+    """
+    Lease settings derived once in __init__, grouped so the hot path loads a single attribute.
+    """
+
+    # In seconds, as returned by tick()
+    interval: float
+    ttl: float
+    # Compared against time.monotonic_ns()
+    interval_ns: int
+    # Renew failures are tolerated until one interval before the lease would expire
+    renew_grace_ns: int
+    token: bytes
+    # The lease check never changes shape, so its EVALSHA is packed once instead of on every tick.
+    # Held in the chunk sequence send_packed_command expects.
+    command: tuple[bytes, ...]
+
+    @classmethod
+    def create(cls, key: str, token: bytes, ttl: float, interval: float) -> '_LeaseConfig':
+        interval_ns = int(interval * 1_000_000_000)
+        # Redis expresses TTLs in milliseconds
+        ttl_ms = int(ttl * 1000)
+        return cls(
+            interval=interval,
+            ttl=ttl,
+            interval_ns=interval_ns,
+            renew_grace_ns=ttl_ms * 1_000_000 - interval_ns,
+            token=token,
+            command=(_pack_command(b'EVALSHA', _LEASE_SHA.encode(), b'1', key.encode(), token, b'%d' % ttl_ms),),
+        )
+
+
+def _on_lease_connect(conn: 'Connection') -> None:
+    """
+    Run the regular connection handshake, then load the lease script, so a fresh pooled
+    connection never answers the first EVALSHA with NOSCRIPT.
+    """
+    conn.on_connect()
+    conn.send_command('SCRIPT', 'LOAD', _LEASE_LUA)
+    conn.read_response()
+
 
 class LeasedSchedulerMixin(__MixinBase):
     """
@@ -36,35 +121,105 @@ class LeasedSchedulerMixin(__MixinBase):
         self.lease_lock_ttl: int = self.app.conf.get('CELERY_LEASE_LOCK_TTL', 60)
         self.lease_interval: int = self.app.conf.get('CELERY_LEASE_INTERVAL', 15)
         self.lease_options: dict = self.app.conf.get('CELERY_LEASE_OPTIONS', {})
+        self.lease_notify: bool = self.app.conf.get('CELERY_LEASE_NOTIFY', False)
 
-        hostname = socket.gethostname()
-        pid = os.getpid()
-        self._lease_lock_id: str = f'{hostname}-{pid}-{uuid.uuid4()}'
+        # The token stored in Redis is the raw 16-byte UUID, which keeps every lease command and the
+        # script's comparison short. The readable id with hostname and pid is only used for logging.
+        token = uuid.uuid4().bytes
+        self._lease_lock_id: str = f'{socket.gethostname()}-{os.getpid()}-{token.hex()}'
+        self._lease_cfg = _LeaseConfig.create(self.lease_lock_key, token, self.lease_lock_ttl, self.lease_interval)
 
         self._lease_redis_client: Redis | RedisCluster | None = None
-        self._lease_lock: Lock | None = None
         self._lease_lock_acquired: bool = False
-        self._lease_renew_threshold: int = max(1, self.lease_lock_ttl // self.lease_interval - 1)
-        self._lease_renew_fail_count: int = 0
-        self._lease_last_acquire_time: float = 0.0
+        self._lease_last_acquire_ns: int = 0
+        # Remaining TTL of the lease held by another instance, as seen on the last failed acquire.
+        # 0 when the holder's TTL is unknown, -1 when the last attempt didn't reach Redis at all.
+        self._lease_holder_ttl_ms: int = -1
+        # Consecutive failed acquires while following, drives the retry backoff
+        self._lease_fail_streak: int = 0
+        # Set by the keyspace notification thread when the lease key is deleted or expires
+        self._lease_released = threading.Event()
+        self._lease_notify_thread: PubSubWorkerThread | None = None
+        # Bound once so the hot path in tick() skips the MRO lookup of super()
+        self._super_tick = super().tick
+        # The client and its pool never change once created, so tick() goes to the pool directly
+        self._lease_connection_pool: ConnectionPool = self.lease_redis_client.connection_pool
+
+        # Connect up front, so the first tick doesn't pay for DNS, TCP, sentinel discovery and the script load
+        try:
+            if 'redis_connect_func' in self.lease_options:
+                # A custom connect hook doesn't load the lease script, so load it with the warm-up round-trip
+                self.lease_redis_client.script_load(_LEASE_LUA)
+            else:
+                # Connecting runs _on_lease_connect, which loads the lease script
+                self.lease_redis_client.ping()
+        except RedisError as e:
+            logger.warning('Failed to connect to Redis, will retry on tick: %s', e)
+
+        if self.lease_notify:
+            self._start_lease_notify()
+
+    def _start_lease_notify(self):
+        """
+        Subscribe to keyspace notifications of the lease key, so followers wake up as soon as it is
+        deleted or expires instead of polling. Needs `notify-keyspace-events` to include `Kgx` on the server.
+        """
+        db = self._lease_connection_pool.connection_kwargs.get('db', 0)
+        channel = f'__keyspace@{db}__:{self.lease_lock_key}'
+        try:
+            pubsub = self.lease_redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: self._on_lease_event})
+        except RedisError as e:
+            logger.warning('Failed to subscribe to lease notifications, falling back to polling: %s', e)
+            return
+        self._lease_notify_thread = pubsub.run_in_thread(
+            sleep_time=1.0,
+            daemon=True,
+            exception_handler=self._on_lease_notify_error,
+        )
+
+    def _on_lease_event(self, message: dict):
+        event = message['data']
+        if isinstance(event, bytes):
+            event = event.decode()
+        if event in ('del', 'expired'):
+            self._lease_released.set()
+
+    def _on_lease_notify_error(self, e: Exception, pubsub: 'PubSub', thread: 'PubSubWorkerThread'):
+        # The pubsub reconnects and resubscribes on the next read, don't spin while Redis is down
+        logger.warning('Error reading lease notifications: %s', e)
+        time.sleep(1.0)
+
+    def _lease_connection_options(self) -> dict:
+        """
+        Connection options for the lease client, `CELERY_LEASE_OPTIONS` overrides these defaults.
+        """
+        timeout = max(1.0, self._lease_cfg.ttl / 3)
+        return {
+            # Don't let a hung Redis block tick() for longer than a fraction of the lease TTL
+            'socket_timeout': timeout,
+            'socket_connect_timeout': timeout,
+            'socket_keepalive': True,
+            'redis_connect_func': _on_lease_connect,
+            **self.lease_options,
+        }
 
     @property
-    def lease_redis_client(self) -> Redis | RedisCluster:
+    def lease_redis_client(self) -> 'Redis | RedisCluster':
         if self._lease_redis_client is None:
+            options = self._lease_connection_options()
             if self.lease_url.startswith('sentinel://'):
                 if not self.lease_options.get('master_name'):
                     raise ValueError('CELERY_LEASE_OPTIONS.master_name must be set for sentinel')
 
-                sentinels = []
-                for url in self.lease_url.split(';'):
-                    if not url.strip():
-                        continue
-                    parsed = urllib.parse.urlparse(url)
-                    sentinels.append((parsed.hostname, parsed.port))
+                from redis.sentinel import Sentinel  # noqa: PLC0415
+
+                sentinels = [
+                    (m.group(1) or m.group(2), int(m.group(3) or _SENTINEL_DEFAULT_PORT))
+                    for m in _SENTINEL_RE.finditer(self.lease_url)
+                ]
 
-                conn_params = {
-                    k: v for k, v in self.lease_options.items() if k not in ('master_name', 'sentinel_kwargs')
-                }
+                conn_params = {k: v for k, v in options.items() if k not in ('master_name', 'sentinel_kwargs')}
                 sentinel = Sentinel(
                     sentinels,
                     sentinel_kwargs=self.lease_options.get('sentinel_kwargs', {}),
@@ -74,99 +229,148 @@ class LeasedSchedulerMixin(__MixinBase):
                     **conn_params,
                 )
             else:
-                self._lease_redis_client = Redis.from_url(self.lease_url, **self.lease_options)
+                self._lease_redis_client = Redis.from_url(self.lease_url, **options)
         return self._lease_redis_client
 
-    @property
-    def lease_lock(self) -> Lock:
-        if self._lease_lock is None:
-            # Create a lock object with our custom ID
-            self._lease_lock = self.lease_redis_client.lock(
-                self.lease_lock_key,
-                timeout=self.lease_lock_ttl,
-                thread_local=False,
-            )
-        return cast(Lock, self._lease_lock)
-
-    @property
-    def _time_since_last_lease(self) -> float:
-        return time.monotonic() - self._lease_last_acquire_time
+    def _send_lease_command(self, conn: 'Connection') -> int:
+        conn.send_packed_command(self._lease_cfg.command)
+        try:
+            return conn.read_response()
+        except NoScriptError:
+            conn.send_command('SCRIPT', 'LOAD', _LEASE_LUA)
+            conn.read_response()
+            conn.send_packed_command(self._lease_cfg.command)
+            return conn.read_response()
 
-    def _acquire_lock(self):
+    def _eval_lease_script(self) -> int:
+        """
+        Run the lease script with the pre-packed EVALSHA, loading it once if the server does not know it yet.
+        Connection errors are retried and handled the same way redis-py does for regular commands.
+        """
+        pool = self._lease_connection_pool
+        conn = pool.get_connection()
         try:
-            # blocking=False means it returns True/False immediately
-            acquired = self.lease_lock.acquire(blocking=False, token=self._lease_lock_id)
-            if acquired:
-                self._lease_last_acquire_time = time.monotonic()
-                if not self._lease_lock_acquired:
-                    logger.info(
-                        "Acquired lock '%s' with id %s. Becoming leader.",
-                        self.lease_lock_key,
-                        self._lease_lock_id,
-                    )
-                self._lease_lock_acquired = True
-                self._lease_renew_fail_count = 0
-                return True
-            return False
-        except (RedisError, LockError) as e:
-            logger.error('Redis error during acquire: %s', e)
-            return False
+            return conn.retry.call_with_retry(
+                lambda: self._send_lease_command(conn),
+                lambda _: conn.disconnect(),
+            )
+        finally:
+            pool.release(conn)
 
-    def _renew_lock(self):
+    def _lease(self) -> bool:
+        """
+        Acquire the lock if it is free or renew it if we own it.
+        Return whether we hold the lock afterwards.
+        """
+        self._lease_holder_ttl_ms = -1
         try:
-            _ = self.lease_lock.reacquire()
-            self._lease_last_acquire_time = time.monotonic()
-            self._lease_renew_fail_count = 0
-            logger.debug('Renewed lock.')
-            return True
-        except (RedisError, LockError) as e:
-            self._lease_renew_fail_count += 1
-            if self._lease_renew_fail_count < self._lease_renew_threshold:
-                logger.warning(
-                    'Failed to renew lock (count %d/%d), skip temporary failure: %s',
-                    self._lease_renew_fail_count,
-                    self._lease_renew_threshold,
-                    e,
-                )
+            rv = self._eval_lease_script()
+        except RedisError as e:
+            if not self._lease_lock_acquired:
+                logger.error('Redis error during acquire: %s', e)
+                return False
+
+            if time.monotonic_ns() - self._lease_last_acquire_ns < self._lease_cfg.renew_grace_ns:
+                logger.warning('Failed to renew lock, skip temporary failure: %s', e)
                 return False
 
             logger.warning('Failed to renew lock (lost ownership): %s', e)
             self._lease_lock_acquired = False
             return False
 
+        if rv <= 0:
+            self._lease_holder_ttl_ms = -rv
+            if self._lease_lock_acquired:
+                logger.warning('Failed to renew lock (lost ownership).')
+                self._lease_lock_acquired = False
+            return False
+
+        self._lease_last_acquire_ns = time.monotonic_ns()
+        self._lease_fail_streak = 0
+        if self._lease_lock_acquired:
+            logger.debug('Renewed lock.')
+        else:
+            logger.info(
+                "Acquired lock '%s' with id %s. Becoming leader.",
+                self.lease_lock_key,
+                self._lease_lock_id,
+            )
+            self._lease_lock_acquired = True
+        return True
+
     def tick(self, *args, **kwargs) -> int | float:
         """
         Run a tick of the scheduler.
         """
-        if self._lease_lock_acquired:
-            if self._time_since_last_lease < self.lease_interval:
-                pass
-            elif not self._renew_lock():
-                return self.lease_interval
-        elif self._acquire_lock():
-            # Just acquired.
-            pass
-        else:
-            # Failed to acquire.
-            logger.debug('Failed to acquire lock, sleeping for %s seconds.', self.lease_interval)
-            return self.lease_interval
-
-        # If we are here, we hold the lock
-        return min(
-            self.lease_interval - self._time_since_last_lease,
-            super().tick(*args, **kwargs),
-        )
+        cfg = self._lease_cfg
+        interval_ns = cfg.interval_ns
+        elapsed_ns = time.monotonic_ns() - self._lease_last_acquire_ns
+        if elapsed_ns < interval_ns and self._lease_lock_acquired:
+            # Still within the lease interval, no need to talk to Redis
+            return min((interval_ns - elapsed_ns) / 1e9, self._super_tick(*args, **kwargs))
+
+        notify = self._lease_notify_thread is not None
+        if notify:
+            # Only count releases that happen from this lease attempt on
+            self._lease_released.clear()
+
+        if not self._lease():
+            if notify and not self._lease_lock_acquired and self._lease_holder_ttl_ms >= 0:
+                # Wait for the key to be released, the holder's TTL bounds the wait if a notification is missed
+                timeout = self._lease_holder_ttl_ms / 1000 or cfg.ttl
+                if self._lease_released.wait(timeout):
+                    logger.debug('Lock was released, retrying now.')
+                return 0
+
+            sleep = cfg.interval
+            if not self._lease_lock_acquired:
+                # Back off with jitter while following, so replicas don't hit Redis in lockstep
+                backoff = min(cfg.ttl / 2, cfg.interval * 2 ** min(self._lease_fail_streak, 4))
+                sleep = random.uniform(cfg.interval, max(cfg.interval, backoff))
+                self._lease_fail_streak += 1
+            holder_ttl_ms = self._lease_holder_ttl_ms
+            if 0 < holder_ttl_ms < sleep * 1000:
+                # The current lease runs out before our next check, retry right when it does
+                sleep = holder_ttl_ms / 1000
+            logger.debug('Lease check failed, retrying in %s seconds.', sleep)
+            return sleep
+
+        # Just acquired or renewed the lock. The lease script already set the TTL, so this tick
+        # needs no further Redis command of its own before running the schedule.
+        return min(cfg.interval, self._super_tick(*args, **kwargs))
+
+    def _release_lock(self):
+        try:
+            # A plain EVAL is always one round-trip, EVALSHA may need a SCRIPT LOAD first
+            if self.lease_redis_client.eval(_RELEASE_LUA, 1, self.lease_lock_key, self._lease_cfg.token):
+                logger.info('Released lock.')
+            else:
+                logger.warning('Lock was already lost before release.')
+            self._lease_lock_acquired = False
+        except RedisError as e:
+            logger.error('Error releasing lock: %s', e)
 
     def close(self):
-        """Release the lock on close."""
+        """Release the lock and the Redis connection on close."""
+        if self._lease_notify_thread is not None:
+            self._lease_notify_thread.stop()
+        release = None
         if self._lease_lock_acquired:
-            try:
-                self.lease_lock.local.token = self._lease_lock_id
-                self.lease_lock.release()
-                logger.info('Released lock.')
-            except (RedisError, LockError) as e:
-                logger.error('Error releasing lock: %s', e)
-        super().close()
+            # The lease and the schedule store are independent, release the lease while the parent syncs its store.
+            # The parent close stays on this thread, as stores like Django's database connection are thread-bound.
+            release = threading.Thread(target=self._release_lock, name='celery-lease-release')
+            release.start()
+        try:
+            super().close()
+        finally:
+            if release is not None:
+                release.join()
+            if self._lease_notify_thread is not None:
+                # stop() only clears the run flag, let the thread finish its current read (sleep_time is 1s)
+                # before the pool it reads from is disconnected
+                self._lease_notify_thread.join(timeout=2.0)
+            if self._lease_redis_client is not None:
+                self._lease_redis_client.close()
 
 
 __all__ = ['LeasedSchedulerMixin']
@@ -238,8 +238,9 @@ def test_leased_django_scheduler_crash(redis_standalone_celery_app: Celery):  #
     for i in range(5):
         mock_apply_async.reset_mock()
         print(f'Iteration {i} (Time {0.75 + i * 0.25}s)')
+        # Followers back off up to half the lock TTL
         tick_sleep = scheduler2.tick()
-        assert tick_sleep <= 0.25
+        assert tick_sleep <= (0.25 if scheduler2._lease_lock_acquired else 0.75 / 2)
         while tick_sleep <= 0:
             tick_sleep = scheduler2.tick()
             assert tick_sleep <= 0.25
@@ -1,9 +1,13 @@
+import time
 from unittest.mock import MagicMock
 
 import pytest
-from celery import Celery
-from redis.exceptions import LockError
+from celery import Celery, beat
+from redis.exceptions import ConnectionError as RedisConnectionError, NoScriptError
 
+from redis.connection import Connection
+
+from celery_leased_beat.lease_mixin import _LEASE_LUA, _LEASE_SHA, _on_lease_connect
 from celery_leased_beat.scheduler import LeasedScheduler
 
 
@@ -27,6 +31,18 @@ def mock_redis(mocker):
     return mock_redis_instance
 
 
+@pytest.fixture
+def mock_lease_conn(mock_redis):
+    mock_conn = mock_redis.connection_pool.get_connection.return_value
+    mock_conn.retry.call_with_retry.side_effect = lambda do, _fail: do()
+    return mock_conn
+
+
+@pytest.fixture
+def mock_lease_script(mock_lease_conn):
+    return mock_lease_conn.read_response
+
+
 @pytest.fixture
 def mock_scheduler_deps(mocker):
     mocker.patch('celery.beat.shelve')
@@ -35,137 +51,357 @@ def mock_scheduler_deps(mocker):
     return mock_tick
 
 
-def test_acquire_lock_success(app, mock_redis, mock_scheduler_deps):
+def test_acquire_lock_success(app, mock_lease_conn, mock_lease_script, mock_scheduler_deps):
     mock_tick = mock_scheduler_deps
 
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
-
-    # Mock lock object
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    mock_lock.acquire.return_value = True
+    mock_lease_script.return_value = 1
 
     # First tick should try to acquire
     scheduler.tick()
 
-    # Check lock creation
-    mock_redis.lock.assert_called_with('test_lock', timeout=10, thread_local=False)
     # Check acquire
-    mock_lock.acquire.assert_called_with(blocking=False, token=scheduler._lease_lock_id)
+    mock_lease_conn.send_packed_command.assert_called_with(scheduler._lease_cfg.command)
 
     assert scheduler._lease_lock_acquired
     mock_tick.assert_called()
 
 
-def test_acquire_lock_failure(app, mock_redis, mock_scheduler_deps):
+def test_acquire_lock_failure(app, mock_lease_conn, mock_lease_script, mock_scheduler_deps):
     mock_tick = mock_scheduler_deps
 
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
-
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    mock_lock.acquire.return_value = False
+    mock_lease_script.return_value = 0
 
     # First tick should try to acquire and fail
     result = scheduler.tick()
 
-    mock_lock.acquire.assert_called_with(blocking=False, token=scheduler._lease_lock_id)
+    mock_lease_conn.send_packed_command.assert_called_with(scheduler._lease_cfg.command)
     assert not scheduler._lease_lock_acquired
     mock_tick.assert_not_called()
     assert result == 1
 
 
-def test_renew_lock_success(app, mock_redis, mock_scheduler_deps):
+@pytest.mark.usefixtures('mock_redis')
+def test_lease_config(app):
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    assert len(scheduler._lease_cfg.token) == 16
+    assert scheduler._lease_cfg.interval == 1
+    assert scheduler._lease_cfg.ttl == 10
+    assert scheduler._lease_cfg.interval_ns == 1_000_000_000
+    assert scheduler._lease_cfg.renew_grace_ns == 9_000_000_000
+
+    expected = Connection().pack_command('EVALSHA', _LEASE_SHA, 1, 'test_lock', scheduler._lease_cfg.token, 10000)
+    assert scheduler._lease_cfg.command == (b''.join(expected),)
+
+
+def test_acquire_lock_loads_missing_script(app, mock_lease_conn, mock_lease_script, mock_scheduler_deps):
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    # EVALSHA fails, SCRIPT LOAD returns the SHA, the retried EVALSHA acquires
+    mock_lease_script.side_effect = [NoScriptError('NOSCRIPT'), _LEASE_SHA, 1]
+
+    scheduler.tick()
+
+    mock_lease_conn.send_command.assert_called_once()
+    assert mock_lease_conn.send_command.call_args.args[:2] == ('SCRIPT', 'LOAD')
+    assert mock_lease_conn.send_packed_command.call_count == 2
+    assert scheduler._lease_lock_acquired
+    mock_scheduler_deps.assert_called()
+
+
+def test_eval_lease_script_real_connection(app, mock_redis):
+    # A real redis-py connection over a stubbed socket, so the packed command goes through send_packed_command
+    sock = MagicMock()
+    sock.recv.side_effect = [
+        b'-NOSCRIPT No matching script. Please use EVAL.\r\n',
+        b'$40\r\n%s\r\n' % _LEASE_SHA.encode(),
+        b':1\r\n',
+    ]
+    conn = Connection()
+    conn._sock = sock
+    conn._parser.on_connect(conn)
+    mock_redis.connection_pool.get_connection.return_value = conn
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    assert scheduler._eval_lease_script() == 1
+
+    sent = [c.args[0] for c in sock.sendall.call_args_list]
+    assert sent == [
+        *scheduler._lease_cfg.command,
+        b''.join(conn.pack_command('SCRIPT', 'LOAD', _LEASE_LUA)),
+        *scheduler._lease_cfg.command,
+    ]
+    mock_redis.connection_pool.release.assert_called_once_with(conn)
+
+
+@pytest.mark.usefixtures('mock_scheduler_deps')
+def test_acquire_lock_failure_backoff(app, mocker, mock_lease_script):
+    # Always pick the upper bound of the jitter range
+    mocker.patch('celery_leased_beat.lease_mixin.random.uniform', side_effect=lambda _low, high: high)
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    mock_lease_script.return_value = 0
+
+    # Interval 1s doubles per miss, capped at half the 10s TTL
+    assert [scheduler.tick() for _ in range(5)] == [1, 2, 4, 5, 5]
+
+    # A successful acquire resets the backoff
+    mock_lease_script.return_value = 1
+    scheduler.tick()
+    scheduler._lease_lock_acquired = False
+    mock_lease_script.return_value = 0
+    assert scheduler.tick() == 1
+
+
+def test_renew_lock_success(app, mock_lease_conn, mock_lease_script, mock_scheduler_deps):
     mock_tick = mock_scheduler_deps
 
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
     scheduler._lease_lock_acquired = True
-
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    # Inject the mock lock into the scheduler instance since we are simulating already acquired state
-    scheduler._lease_lock = mock_lock
+    mock_lease_script.return_value = 2
 
     scheduler.tick()
 
-    mock_lock.reacquire.assert_called_with()
+    mock_lease_conn.send_packed_command.assert_called_with(scheduler._lease_cfg.command)
     assert scheduler._lease_lock_acquired
     mock_tick.assert_called()
 
 
-def test_renew_lock_tolerance_success(app, mock_redis, mock_scheduler_deps):
+def test_renew_lock_tolerance_success(app, mock_lease_script, mock_scheduler_deps):
     mock_tick = mock_scheduler_deps
 
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
     scheduler._lease_lock_acquired = True
+    # Renewed 2s ago, the 10s lease is far from expiring
+    scheduler._lease_last_acquire_ns = time.monotonic_ns() - 2_000_000_000
 
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    scheduler._lease_lock = mock_lock
-
-    # Simulate one failure (LockError)
-    mock_lock.reacquire.side_effect = LockError('Temporary failure')
+    # Simulate a burst of fast failures (connection error)
+    mock_lease_script.side_effect = RedisConnectionError('Temporary failure')
+    for _ in range(20):
+        scheduler.tick()
 
-    # First tick with failure
-    scheduler.tick()
-
-    # Should still hold lock because threshold (60/15 - 1 = 3) > 1
+    # Should still hold lock because the deadline (10s TTL - 1s interval) has not passed
     assert scheduler._lease_lock_acquired
     mock_tick.assert_not_called()
 
     # Reset side effect for next call to simulate recovery
-    mock_lock.reacquire.side_effect = None
+    mock_lease_script.side_effect = None
+    mock_lease_script.return_value = 2
 
     scheduler.tick()
     assert scheduler._lease_lock_acquired
-    assert scheduler._lease_renew_fail_count == 0
     mock_tick.assert_called()
 
 
-def test_renew_lock_tolerance_failure(app, mock_redis):
+def test_renew_lock_tolerance_failure(app, mock_lease_script):
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    scheduler._lease_lock_acquired = True
+    # Renewed 8.5s ago, the deadline is 9s (10s TTL - 1s interval)
+    scheduler._lease_last_acquire_ns = time.monotonic_ns() - 8_500_000_000
+
+    mock_lease_script.side_effect = RedisConnectionError('Persistent failure')
+
+    scheduler.tick()
+    assert scheduler._lease_lock_acquired
+
+    # Past the deadline, step down before the lease can expire under us
+    scheduler._lease_last_acquire_ns -= 1_000_000_000
+    scheduler.tick()
+    assert not scheduler._lease_lock_acquired
+
+
+def test_renew_lock_failure(app, mock_lease_script):
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
     scheduler._lease_lock_acquired = True
-    # Set values to get threshold = 3 (60 // 15 - 1 = 3)
-    scheduler.lease_lock_ttl = 60
-    scheduler.lease_interval = 15
-    scheduler._lease_renew_threshold = max(1, scheduler.lease_lock_ttl // scheduler.lease_interval - 1)
 
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    scheduler._lease_lock = mock_lock
+    # The script returns 0 when the lock is held by someone else, which steps down at once
+    mock_lease_script.return_value = 0
+
+    scheduler.tick()
+
+    assert not scheduler._lease_lock_acquired
+
+
+def test_connection_options(app, mocker):
+    mock_redis_cls = mocker.patch('celery_leased_beat.lease_mixin.Redis')
+    app.conf.update(CELERY_LEASE_OPTIONS={'socket_timeout': 0.5, 'password': 'secret'})
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    _ = scheduler.lease_redis_client
+
+    # User options override the defaults
+    mock_redis_cls.from_url.assert_called_once_with(
+        'redis://localhost:6379/0',
+        socket_timeout=0.5,
+        socket_connect_timeout=10 / 3,
+        socket_keepalive=True,
+        redis_connect_func=_on_lease_connect,
+        password='secret',
+    )
+
+
+def test_init_connects(app, mock_redis):
+    LeasedScheduler(app=app, schedule_filename='schedule')
+
+    mock_redis.ping.assert_called_once_with()
+    mock_redis.script_load.assert_not_called()
+
+
+def test_init_loads_script_with_custom_connect_func(app, mock_redis):
+    app.conf.update(CELERY_LEASE_OPTIONS={'redis_connect_func': MagicMock()})
+
+    LeasedScheduler(app=app, schedule_filename='schedule')
 
-    mock_lock.reacquire.side_effect = LockError('Persistent failure')
+    mock_redis.script_load.assert_called_once_with(_LEASE_LUA)
+    mock_redis.ping.assert_not_called()
 
-    # Threshold is 3.
-    # 1st fail
+
+def test_init_tolerates_unreachable_redis(app, mock_redis, mock_lease_script, mock_scheduler_deps):
+    mock_redis.ping.side_effect = RedisConnectionError('Connection refused')
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    assert not scheduler._lease_lock_acquired
+
+    # Redis is back by the first tick
+    mock_lease_script.return_value = 1
     scheduler.tick()
     assert scheduler._lease_lock_acquired
+    mock_scheduler_deps.assert_called()
+
+
+def test_on_lease_connect_loads_script():
+    mock_conn = MagicMock()
 
-    # 2nd fail
+    _on_lease_connect(mock_conn)
+
+    mock_conn.on_connect.assert_called_once_with()
+    mock_conn.send_command.assert_called_once_with('SCRIPT', 'LOAD', _LEASE_LUA)
+    mock_conn.read_response.assert_called_once_with()
+
+
+def test_notify_waits_for_release(app, mock_redis, mock_lease_script, mock_scheduler_deps):
+    app.conf.update(CELERY_LEASE_NOTIFY=True)
+    mock_redis.connection_pool.connection_kwargs = {'db': 2}
+    mock_pubsub = mock_redis.pubsub.return_value
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+
+    handler = mock_pubsub.subscribe.call_args.kwargs['__keyspace@2__:test_lock']
+    mock_pubsub.run_in_thread.assert_called_once()
+
+    # Held by someone else for another 50ms: wait for the key to go away, then retry at once
+    mock_lease_script.return_value = -50
+    assert scheduler.tick() == 0
+    assert not scheduler._lease_released.is_set()
+
+    # Renewals of the holder don't wake us up, deletion and expiry do
+    handler({'type': 'message', 'data': b'expire'})
+    assert not scheduler._lease_released.is_set()
+    handler({'type': 'message', 'data': b'del'})
+    assert scheduler._lease_released.is_set()
+
+    mock_lease_script.return_value = 1
     scheduler.tick()
     assert scheduler._lease_lock_acquired
+    mock_scheduler_deps.assert_called()
+
+    mock_thread = mock_pubsub.run_in_thread.return_value
+    # The thread is joined before the pool it reads from is disconnected
+    mock_thread.join.side_effect = lambda **_: mock_redis.close.assert_not_called()
+    scheduler.close()
+    mock_thread.stop.assert_called_once_with()
+    mock_thread.join.assert_called_once_with(timeout=2.0)
+    mock_redis.close.assert_called_once_with()
+
+
+def test_notify_skips_wait_on_redis_error(app, mocker, mock_redis, mock_lease_script, mock_scheduler_deps):
+    app.conf.update(CELERY_LEASE_NOTIFY=True)
+    mock_redis.connection_pool.connection_kwargs = {'db': 0}
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    mock_wait = mocker.patch.object(scheduler._lease_released, 'wait')
+
+    # No holder was reported, so there is nothing to wait for: fall back to the normal backoff
+    mock_lease_script.side_effect = RedisConnectionError('Connection refused')
+    assert scheduler.tick() == 1
+    mock_wait.assert_not_called()
+    mock_scheduler_deps.assert_not_called()
+
+
+def test_tick_within_interval_skips_redis(app, mock_lease_script, mock_scheduler_deps):
+    mock_tick = mock_scheduler_deps
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    mock_lease_script.return_value = 1
 
-    # 3rd fail should step down
     scheduler.tick()
-    assert not scheduler._lease_lock_acquired
+    assert mock_lease_script.call_count == 1
+
+    # Second tick is within the lease interval, so only the scheduler itself should run
+    result = scheduler.tick()
+    assert mock_lease_script.call_count == 1
+    assert mock_tick.call_count == 2
+    assert 0 <= result <= 1
 
 
-def test_renew_lock_failure(app, mock_redis):
+@pytest.mark.usefixtures('mock_scheduler_deps')
+def test_close_releases_lock(app, mock_redis):
     scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
     scheduler._lease_lock_acquired = True
-    # Set low threshold to fail quickly. TTL=10, Interval=10 => Threshold = max(1, 0) = 1.
-    # Count=1 < 1 False. So fails on 1st try.
-    scheduler.lease_lock_ttl = 10
-    scheduler.lease_interval = 10
-    scheduler._lease_renew_threshold = max(1, scheduler.lease_lock_ttl // scheduler.lease_interval - 1)
+    mock_redis.eval.return_value = 1
 
-    mock_lock = MagicMock()
-    mock_redis.lock.return_value = mock_lock
-    scheduler._lease_lock = mock_lock
+    scheduler.close()
 
-    # reacquire raises LockError if failed (e.g. lost lock)
-    mock_lock.reacquire.side_effect = LockError('Lost lock')
+    mock_redis.eval.assert_called_once()
+    assert mock_redis.eval.call_args.args[1:] == (1, 'test_lock', scheduler._lease_cfg.token)
+    mock_redis.close.assert_called_once_with()
+    assert not scheduler._lease_lock_acquired
+    # The parent close still runs, alongside the release
+    beat.Scheduler.close.assert_called_once_with()
 
-    scheduler.tick()
+
+@pytest.mark.usefixtures('mock_scheduler_deps')
+def test_sentinel_url_parsing(app, mocker):
+    mock_sentinel_cls = mocker.patch('redis.sentinel.Sentinel')
+    app.conf.update(
+        CELERY_LEASE_URL=(
+            'sentinel://localhost:26379;sentinel://:password@10.0.0.2:26380;sentinel://sentinel3;'
+            'sentinel://[::1]:26381;sentinel://user:p@ss@sentinel5:1'
+        ),
+        CELERY_LEASE_OPTIONS={'master_name': 'mymaster'},
+    )
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+    _ = scheduler.lease_redis_client
+
+    sentinels = mock_sentinel_cls.call_args.args[0]
+    assert sentinels == [
+        ('localhost', 26379),
+        ('10.0.0.2', 26380),
+        ('sentinel3', 26379),
+        ('::1', 26381),
+        ('sentinel5', 1),
+    ]
+    mock_sentinel_cls.return_value.master_for.assert_called_once_with(
+        'mymaster',
+        socket_timeout=10 / 3,
+        socket_connect_timeout=10 / 3,
+        socket_keepalive=True,
+        redis_connect_func=_on_lease_connect,
+    )
+
+
+def test_acquire_lock_failure_retries_at_holder_expiry(app, mock_lease_script, mock_scheduler_deps):
+    mock_tick = mock_scheduler_deps
+
+    scheduler = LeasedScheduler(app=app, schedule_filename='schedule')
+
+    # The holder's lease has 300ms left, which is shorter than our 1s interval
+    mock_lease_script.return_value = -300
+    assert scheduler.tick() == 0.3
+
+    # The holder's lease outlives our backoff, so just wait for the next check
+    mock_lease_script.return_value = -5000
+    assert 1 <= scheduler.tick() <= 2
 
     assert not scheduler._lease_lock_acquired
+    mock_tick.assert_not_called()